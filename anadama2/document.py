@@ -4,9 +4,28 @@ import tempfile
 import shutil
 import subprocess
 import itertools
+import base64
+import collections
+import hashlib
+import gzip
+import operator
+import re
 import sys
+import stat
+import atexit
+import mmap
+import multiprocessing
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+import six
 
 from .helpers import sh
+from .util import ShellException
+from .util import capture
+from .util import find_on_path
+from .util import mkdirp
 from . import Task
 
 try:
@@ -14,10 +33,417 @@ try:
 except ImportError:
     import pickle
     
-try:
-    from StringIO import StringIO
-except ImportError:
-    from io import StringIO
+class _RSession(object):
+    """ A long running R process which is shared by all documents so the
+    R startup cost is only paid once per process """
+    
+    sentinel="###DONE###"
+    _instance=None
+    
+    def __init__(self):
+        self.proc=subprocess.Popen(["R","--vanilla","--slave","--no-readline"],
+            stdin=subprocess.PIPE, stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
+        
+    @classmethod
+    def singleton(cls):
+        """ Get the shared R session, starting R if needed """
+        
+        if cls._instance is None:
+            cls._instance=cls()
+            atexit.register(cls.close_instance)
+        elif cls._instance.proc.poll() is not None:
+            # R stops on the first error when not interactive so start a new session
+            cls._instance.close()
+            cls._instance=cls()
+        return cls._instance
+        
+    @classmethod
+    def close_instance(cls):
+        """ Stop the shared R session if it is running """
+        
+        if cls._instance is not None:
+            cls._instance.close()
+        
+    @staticmethod
+    def script(commands, args):
+        """ Get the script to run the commands in their own scope with the arguments """
+        
+        # the arguments are returned by commandArgs as if provided on the command line
+        r_args=",".join('"'+arg.replace("\\","\\\\").replace('"','\\"')+'"' for arg in args)
+        return ["local({","commandArgs<-function(trailingOnly=FALSE) c("+r_args+")"]+commands+["})"]
+        
+    def run(self, commands, args):
+        """ Run the commands in the session and return the output """
+        
+        script=self.script(commands, args)+["cat('"+self.sentinel+"\\n')"]
+        self.proc.stdin.write(bytearray("\n".join(script)+"\n",'utf-8'))
+        self.proc.stdin.flush()
+        
+        # read until the end of the commands is reached (or R exits on error)
+        output=[]
+        for line in iter(self.proc.stdout.readline, b""):
+            line=line.decode("utf-8")
+            if line.rstrip() == self.sentinel:
+                break
+            output.append(line)
+        else:
+            # R has exited, wait for it so the next commands start a new session
+            self.proc.wait()
+            raise ShellException(self.proc.returncode, "Error running R commands:\n"+"".join(output))
+        return "".join(output)
+    
+    def close(self):
+        """ Stop the R process """
+        
+        try:
+            self.proc.stdin.write(b"q()\n")
+            self.proc.stdin.close()
+        except EnvironmentError:
+            pass
+        self.proc.wait()
+        self.proc.stdout.close()
+
+# rpy2 is optional, if installed R is run in this process instead of the shared session
+# (only one set of R commands can run at a time with either)
+_rpy2_robjects = None
+_r_lock = threading.Lock()
+
+def _import_rpy2():
+    """ Import the rpy2 R interface on first use (False if not installed) """
+    
+    global _rpy2_robjects
+    if _rpy2_robjects is None:
+        try:
+            from rpy2 import robjects
+        except ImportError:
+            robjects = False
+        _rpy2_robjects = robjects
+    return _rpy2_robjects
+
+# the most recent PCoA results, shared by all documents since documents are copied
+# (the same data is commonly plotted more than once with different metadata)
+_PCOA_CACHE_SIZE = 8
+_pcoa_cache = collections.OrderedDict()
+
+# the PCoA results being computed in the background
+_pcoa_pending = {}
+_pcoa_executor = None
+
+def _get_pcoa_executor():
+    """ Get the thread used to compute PCoA results in the background """
+    
+    global _pcoa_executor
+    if _pcoa_executor is None:
+        # one thread is enough to overlap the computation with drawing plots
+        _pcoa_executor = ThreadPoolExecutor(max_workers=1)
+    return _pcoa_executor
+
+# the figures used to write plots to files, one for each figure size
+# these are not managed by pyplot so they are reused and are not shown in documents
+_file_figures = {}
+
+def _get_figure(outfilename, **keywords):
+    """ Get a new pyplot figure, or a cleared reusable figure if the plot is written to a file """
+    
+    if not outfilename:
+        return pyplot.figure(**keywords)
+    
+    key = tuple(sorted(keywords.items()))
+    if key not in _file_figures:
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        figure = Figure(**keywords)
+        FigureCanvasAgg(figure)
+        _file_figures[key] = figure
+        
+    figure = _file_figures[key]
+    figure.clear()
+    return figure
+
+# set this environment variable to draw plots with the non-interactive Agg backend
+HEADLESS_ENVIRONMENT_VARIABLE = "ANADAMA2_HEADLESS"
+
+# numpy and matplotlib are only required to generate documents
+# so they are imported the first time they are needed
+numpy = None
+pyplot = None
+matplotlib = None
+
+def _import_plotting():
+    """ Import numpy, matplotlib and matplotlib.pyplot into the module on first use """
+    
+    global numpy, pyplot, matplotlib
+    if pyplot is None:
+        import numpy as numpy_module
+        import matplotlib as matplotlib_module
+        # use the non-interactive backend for batch reports if requested
+        # (unless pyplot was already set up, for example by pweave)
+        if os.environ.get(HEADLESS_ENVIRONMENT_VARIABLE) and "matplotlib.pyplot" not in sys.modules:
+            matplotlib_module.use("Agg")
+        import matplotlib.pyplot as pyplot_module
+        # import the submodules used by the plots once so the methods do not import these each call
+        import matplotlib.cm, matplotlib.colors, matplotlib.lines, matplotlib.table, matplotlib.ticker
+        numpy, pyplot, matplotlib = numpy_module, pyplot_module, matplotlib_module
+
+def _check_executable(executable, message):
+    """ Exit with the message if the executable can not be found """
+    
+    # search the path instead of running the executable
+    if not find_on_path(executable):
+        sys.exit(message)
+
+def _transfer_files(function, files, folder):
+    """ Copy or move (with the function) the files to the folder in parallel """
+    
+    with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1)*4)) as pool:
+        # get the results to raise any errors
+        list(pool.map(lambda file: function(file, os.path.join(folder, os.path.basename(file))), files))
+
+# the colors from each matplotlib color map used for the custom plot colors
+_colormaps = {}
+
+def _colormap_colors(name, total):
+    """ Get the colors from the color map (only sampled once for all plots) """
+    
+    if name not in _colormaps:
+        _import_plotting()
+        colormap=getattr(matplotlib.cm, name)
+        _colormaps[name]=tuple(colormap(i/float(total)) for i in range(total))
+    return _colormaps[name]
+
+def _is_number(value):
+    """ Check if the value can be converted to a number """
+    
+    try:
+        float(value)
+    except (TypeError, ValueError):
+        return False
+    return True
+
+def _pcoa_coordinates(data, apply_transform):
+    """ Compute the first two principal coordinates of the samples (columns) in the data
+    returning these with the percent of variance explained by each """
+    
+    from scipy.spatial.distance import pdist, squareform
+    
+    # remove any samples from the data for which all features are zero
+    data=data[:,data.sum(axis=0) != 0]
+
+    # remove any features from the data for which all samples have zero values
+    data=data[data.sum(axis=1) != 0]
+
+    # compute the Bray-Curtis dissimilarities between all pairs of samples
+    # (with the values for each sample contiguous in memory)
+    sample_data=numpy.ascontiguousarray(data.T)
+    if apply_transform:
+        sample_data=numpy.arcsin(numpy.sqrt(sample_data))
+    distances=squareform(pdist(sample_data,metric="braycurtis"))
+
+    # double center the squared distances and get the principal coordinates
+    # subtracting the means is the same as multiplying by the centering matrix on both sides
+    # without the two matrix multiplications
+    squared=distances**2
+    row_means=squared.mean(axis=1)
+    centered=-0.5*(squared-row_means[:,None]-row_means[None,:]+row_means.mean())
+    eigenvalues, eigenvectors=numpy.linalg.eigh(centered)
+    
+    # order the coordinates by decreasing eigenvalue
+    order=numpy.argsort(eigenvalues)[::-1]
+    eigenvalues=eigenvalues[order]
+    eigenvectors=eigenvectors[:,order]
+    
+    # get the x and y labels as the percent of variance explained
+    explained=eigenvalues/eigenvalues[eigenvalues > 0].sum()
+    pcoa1_x_label=int(explained[0]*100)
+    pcoa2_y_label=int(explained[1]*100)
+    
+    # get the scores to plot
+    pcoa_data=(eigenvectors[:,:2]*numpy.sqrt(numpy.maximum(eigenvalues[:2],0))).tolist()
+
+    return pcoa_data, pcoa1_x_label, pcoa2_y_label
+
+# the folder for temp files written by plots (removed on exit)
+_temp_directory = None
+
+def _get_temp_directory():
+    """ Get the temp folder for this process, creating it on first use """
+    
+    global _temp_directory
+    if _temp_directory is None:
+        # this is created in TMPDIR if set
+        _temp_directory = tempfile.mkdtemp(prefix="anadama2_")
+        atexit.register(shutil.rmtree, _temp_directory, ignore_errors=True)
+    return _temp_directory
+
+def _read_image(file):
+    """ Read the image into an array of 8 bit values (imread returns floats for png files) """
+    
+    try:
+        from PIL import Image
+    except ImportError:
+        return pyplot.imread(file)
+    
+    with Image.open(file) as image:
+        # palette and other modes are not drawn as colors by imshow
+        if image.mode not in ["RGB", "RGBA", "L"]:
+            image = image.convert("RGBA")
+        return numpy.asarray(image)
+
+def _linear_fit(x, y):
+    """ Compute the least squares line for the points (returns the slope and intercept) """
+    
+    x_offsets = x - x.mean()
+    sum_squares = (x_offsets*x_offsets).sum()
+    # a vertical set of points does not have a slope so use a flat line
+    slope = (x_offsets*(y - y.mean())).sum() / sum_squares if sum_squares else 0.0
+    return slope, y.mean() - slope*x.mean()
+
+# the import sections in templates, from the import line to the next line starting with ```
+_IMPORT_SECTION_START = re.compile(br"^```\{import", re.MULTILINE)
+_IMPORT_SECTION = re.compile(br"^```\{import[^\n]*\n?(.*?)^```[^\n]*\n?", re.MULTILINE | re.DOTALL)
+
+def _has_imports(file_handle):
+    """ Check if the template has import sections without reading it into memory """
+    
+    try:
+        with mmap.mmap(file_handle.fileno(), 0, access=mmap.ACCESS_READ) as contents:
+            return contents.find(b"```{import") != -1
+    except ValueError:
+        # empty files can not be mapped
+        return False
+
+def _append_file(source, destination):
+    """ Append the source file to the destination file """
+    
+    offset = 0
+    if sys.platform.startswith("linux"):
+        # copy in the kernel so the contents are not read into memory
+        destination.flush()
+        size = os.fstat(source.fileno()).st_size
+        try:
+            while offset < size:
+                sent = os.sendfile(destination.fileno(), source.fileno(), offset, size-offset)
+                if sent == 0:
+                    break
+                offset += sent
+        except OSError:
+            pass
+        
+    # copy the remainder of the file if the copy in the kernel is not available
+    source.seek(offset)
+    shutil.copyfileobj(source, destination)
+
+# the custom pweave classes (only created once, on first use, since pweave is slow to import)
+_pweave_classes = None
+
+def _get_pweave_classes():
+    """ Get the pweave processor and formatter classes customized for documents """
+    
+    global _pweave_classes
+    if _pweave_classes is None:
+        from pweave import PwebPandocFormatter, PwebProcessor
+
+        class PwebProcessorSpaces(PwebProcessor):
+            def loadinline(self, content):
+                """Function from pweave slightly modified to allow for spaces in code"""
+                """Evaluate code from doc chunks using ERB markup"""
+                # Flags don't work with ironpython
+                import re
+                splitted = re.split('(<%[\w\s\W]*?%>)', content)  # , flags = re.S)
+                # No inline code
+                if len(splitted) < 2:
+                    return content
+
+                n = len(splitted)
+
+                for i in range(n):
+                    elem = splitted[i]
+                    if not elem.startswith('<%'):
+                        continue
+                    if elem.startswith('<%='):
+                        code_str = elem.replace('<%=', '').replace('%>', '').lstrip()
+                        result = self.loadstring(self.add_echo(code_str)).strip()
+                        splitted[i] = result
+                        continue
+                    if elem.startswith('<%'):
+                        code_str = elem.replace('<%', '').replace('%>', '').lstrip()
+                        #result = self.loadstring(code_str).strip()
+                        # small modification from original code to allow for spaces at the end
+                        # spaces after figures are required for figure captions with pandoc
+                        result = self.loadstring(code_str).lstrip().replace("\n","",1)
+                        splitted[i] = result
+                return ''.join(splitted)
+
+        class PwebPandocFormatterFixedFigures(PwebPandocFormatter):
+            def __init__(self, *args, **kwargs):
+                super(PwebPandocFormatterFixedFigures, self).__init__(*args, **kwargs)
+                # pick the figure string once since the pandoc version is set when created
+                # only use width if pandoc installed is >= v1.16.0
+                if self.new_pandoc:
+                    self.make_figure_string_size = self.make_figure_string_width
+                
+            def make_figure_string_size(self, figname, width, label, caption = ""):
+                # new function to fix figure width string to work with pandoc format
+                if caption == "":
+                    return "![%s](%s)\n\\\n" % (caption, figname)
+                return "![%s](%s)\n\n" % (caption, figname)
+            
+            def make_figure_string_width(self, figname, width, label, caption = ""):
+                if caption == "":
+                    return "![%s](%s){ width=%s }\n\\\n" % (caption, figname, width)
+                return "![%s](%s){ width=%s }\n\n" % (caption, figname, width)
+
+            def formatfigure(self, chunk):
+                fignames = chunk['figure']
+                if chunk["caption"]:
+                    caption = chunk["caption"]
+                else:
+                    caption = ""
+                figstring = ""
+                
+                # increase default figure size
+                if not chunk["width"]:
+                    chunk["width"]="100%"
+        
+                if chunk['caption'] and len(fignames) > 0:
+                    if len(fignames) > 1:
+                        print("INFO: Only including the first plot in a chunk when the caption is set")
+                        figstring = self.make_figure_string_size(fignames[0], chunk["width"], chunk["name"], caption)
+                        return figstring
+        
+                for fig in fignames:
+                    # original line which duplicates figures commented out and replaced
+                    #figstring += self.make_figure_string(fignames[0], chunk["width"], chunk["name"])
+                    figstring += self.make_figure_string_size(fig, chunk["width"], chunk["name"])
+        
+                return figstring
+            
+        _pweave_classes = (PwebProcessorSpaces, PwebPandocFormatterFixedFigures)
+    return _pweave_classes
+
+# the environment variable holding small sets of pickled document variables
+_VARS_ENVIRONMENT_VARIABLE = "ANADAMA2_DOCUMENT_VARS"
+# larger sets of variables are written to a pickle file (environment size is limited)
+_MAX_ENVIRONMENT_VARS_SIZE = 32*1024
+
+def _load_vars(pickled_vars):
+    """ Load the pickled document variables (which can be gzip compressed) """
+    
+    # check for the gzip magic bytes (pickles start with the protocol)
+    if pickled_vars[:2] == b"\x1f\x8b":
+        pickled_vars = gzip.decompress(pickled_vars)
+    return pickle.loads(pickled_vars)
+
+def _weave(template, output, environment):
+    """ Weave the template with pweave (run in a child process of the document) """
+    
+    import pweave
+    
+    os.environ.update(environment)
+    
+    # the messages from pweave are not needed
+    sys.stdout = open(os.devnull, "w")
+    pweave.weave(template, output=output)
 
 class Document(object):
     """A document that is auto generated from a template. 
@@ -83,11 +509,12 @@ class PweaveDocument(Document):
         # set the location of the final figures and data folders
         # only create if the document has a target
         if self.targets:
-            self.figures_folder = os.path.join(os.path.dirname(self.targets[0]),"figures")
+            target_folder = os.path.dirname(self.targets[0])
+            self.figures_folder = os.path.join(target_folder,"figures")
             if not os.path.isdir(self.figures_folder):
                 os.makedirs(self.figures_folder)
                 
-            self.data_folder = os.path.join(os.path.dirname(self.targets[0]),"data")
+            self.data_folder = os.path.join(target_folder,"data")
             if not os.path.isdir(self.data_folder):
                 os.makedirs(self.data_folder)
         else:
@@ -98,8 +525,9 @@ class PweaveDocument(Document):
                 self.vars=None
                 
             if self.vars:
-                self.figures_folder = os.path.join(os.path.dirname(self.vars["targets"][0]),"figures")
-                self.data_folder = os.path.join(os.path.dirname(self.vars["targets"][0]),"data")
+                target_folder = os.path.dirname(self.vars["targets"][0])
+                self.figures_folder = os.path.join(target_folder,"figures")
+                self.data_folder = os.path.join(target_folder,"data")
         
         # check for the required dependencies when using a pweave document
         # only check when creating an instance with a template to run
@@ -117,22 +545,13 @@ class PweaveDocument(Document):
             except ImportError:
                 sys.exit("Please install matplotlib for document generation")
                 
-            try:
-                output=subprocess.check_output(["pypublish","-h"],stderr=subprocess.STDOUT)
-            except EnvironmentError:
-                sys.exit("Please install pweave for document generation")
-                
-            try:
-                output=subprocess.check_output(["pdflatex","--help"],stderr=subprocess.STDOUT)
-            except EnvironmentError:
-                sys.exit("Please install latex which includes pdflatex for document generation")
+            _check_executable("pypublish", "Please install pweave for document generation")
+            _check_executable("pdflatex", "Please install latex which includes pdflatex for document generation")
                 
         # copy over the file dependencies to the data folder
         if self.depends and self.data_folder and os.path.isdir(self.data_folder):
-            depends_files = list(filter(lambda x: not isinstance(x,Task), self.depends))
-            for data_file in depends_files:
-                if data_file:
-                    shutil.copy(data_file,os.path.join(self.data_folder,os.path.basename(data_file)))
+            depends_files = list(filter(lambda x: x and not isinstance(x,Task), self.depends))
+            _transfer_files(shutil.copy, depends_files, self.data_folder)
 
     def print_title(self):
         if self.vars["header_image"]:
@@ -150,16 +569,18 @@ class PweaveDocument(Document):
         template_extension=os.path.splitext(self.templates[0])[-1]
             
         # get the report and figure extensions based on the target
-        report_filename, report_extension=os.path.splitext(self.targets[0])
+        target_file=self.targets[0]
+        target_folder=os.path.dirname(target_file)
+        report_filename, report_extension=os.path.splitext(target_file)
 
         # create the temp file to run with when ready to create the document
-        temp_directory = tempfile.mkdtemp(dir=os.path.dirname(self.targets[0]))
+        temp_directory = tempfile.mkdtemp(dir=target_folder)
         temp_template_basename = os.path.join(temp_directory,os.path.basename(report_filename))
         # keep the extension of the template for pweave auto reader function
         temp_template = temp_template_basename + template_extension
         
-        # if variables are provided, then create a pickled file to store these
-        # for use when the document is created
+        # if variables are provided, then pickle these for use when the document is created
+        vars_environment={}
         if self.vars is not None:
             # save the depends in the vars set
             self.vars["depends"]=self.depends
@@ -169,41 +590,61 @@ class PweaveDocument(Document):
             
             # change directories/files to the full paths (so no longer required in input)
             # this is because pweave does not have an output folder option (just cwd so a ch is needed)
-            for variable in self.vars:
+            for variable, value in self.vars.items():
+                # ignore lists, numbers and None values without checking the file system
+                if not isinstance(value, six.string_types):
+                    continue
+                # one stat for the file or directory
                 try:
-                    if os.path.isdir(self.vars[variable]) or os.path.isfile(self.vars[variable]):
-                        self.vars[variable] = os.path.abspath(self.vars[variable])
-                except (TypeError, ValueError, NameError):
-                    # ignore lists and None values
+                    stat_result=os.stat(value)
+                except (EnvironmentError, ValueError):
                     continue
-            # create a picked file with the temp template name in the same folder
-            pickle.dump(self.vars, open(temp_template_basename+".pkl", "wb"))
+                if stat.S_ISDIR(stat_result.st_mode) or stat.S_ISREG(stat_result.st_mode):
+                    self.vars[variable] = os.path.abspath(value)
+            # compress (quickly) since these can include large data sets
+            pickled_vars=gzip.compress(pickle.dumps(self.vars, protocol=pickle.HIGHEST_PROTOCOL), compresslevel=1)
+            
+            # pass small sets of variables to the weave process in its environment
+            # python templates are woven in this process so always use a file for these
+            if template_extension != ".py" and len(pickled_vars) <= _MAX_ENVIRONMENT_VARS_SIZE:
+                vars_environment[_VARS_ENVIRONMENT_VARIABLE]=base64.b64encode(pickled_vars).decode("ascii")
+            else:
+                # create a picked file with the temp template name in the same folder
+                # write to a temp file first so a partial pickle file is never read
+                pickle_handle, pickle_temp_file=tempfile.mkstemp(dir=temp_directory)
+                with os.fdopen(pickle_handle, "wb") as file_handle:
+                    file_handle.write(pickled_vars)
+                os.replace(pickle_temp_file, temp_template_basename+".pkl")
 
         # merge the templates into the temp file
         templates_globals=globals()
         templates_globals["vars"]=self.vars
         templates_globals["filename"]=""
-        with open(temp_template,"w") as handle:
+        with open(temp_template,"wb") as handle:
             for file in self.templates:
-                current_import_section=""
-                capture_import=False
-                for line in open(file):
-                    # look for and process imports
-                    if line.startswith("```{import"):
-                        capture_import=True
-                    elif line.startswith("```") and capture_import:
-                        exec(current_import_section, templates_globals)
-                        if "filename" in templates_globals and templates_globals["filename"]:
-                            # import the file to the template
-                            for importline in open(os.path.join(os.path.dirname(file),filename)):
-                                handle.write(importline)
-                        templates_globals["filename"]=""
-                        current_import_section=""
-                        capture_import=False
-                    elif capture_import:
-                        current_import_section+=line
-                    else: 
-                        handle.write(line)
+                with open(file,"rb") as template_handle:
+                    # copy templates without imports as a single block
+                    if not _has_imports(template_handle):
+                        _append_file(template_handle, handle)
+                        continue
+                    template=template_handle.read()
+                    
+                # copy the text between the import sections as blocks
+                position=0
+                for import_section in _IMPORT_SECTION.finditer(template):
+                    handle.write(template[position:import_section.start()])
+                    position=import_section.end()
+                    # process the import
+                    exec(import_section.group(1).decode("utf-8"), templates_globals)
+                    if "filename" in templates_globals and templates_globals["filename"]:
+                        # import the file to the template
+                        with open(os.path.join(os.path.dirname(file),templates_globals["filename"]),"rb") as import_handle:
+                            _append_file(import_handle, handle)
+                    templates_globals["filename"]=""
+                    
+                # an import section without an end is not included
+                unfinished_import=_IMPORT_SECTION_START.search(template, position)
+                handle.write(template[position:unfinished_import.start() if unfinished_import else len(template)])
                 
         # create the document
         # first move to the directory with the temp output files
@@ -229,94 +670,35 @@ class PweaveDocument(Document):
         # run pweave then pandoc to generate document
  
         # call pweave to use class with fix
-        from pweave import PwebPandocFormatter, Pweb, PwebProcessor
-        from pweave.readers import PwebScriptReader
-
-        class PwebProcessorSpaces(PwebProcessor):
-            def loadinline(self, content):
-                """Function from pweave slightly modified to allow for spaces in code"""
-                """Evaluate code from doc chunks using ERB markup"""
-                # Flags don't work with ironpython
-                import re
-                splitted = re.split('(<%[\w\s\W]*?%>)', content)  # , flags = re.S)
-                # No inline code
-                if len(splitted) < 2:
-                    return content
-
-                n = len(splitted)
-
-                for i in range(n):
-                    elem = splitted[i]
-                    if not elem.startswith('<%'):
-                        continue
-                    if elem.startswith('<%='):
-                        code_str = elem.replace('<%=', '').replace('%>', '').lstrip()
-                        result = self.loadstring(self.add_echo(code_str)).strip()
-                        splitted[i] = result
-                        continue
-                    if elem.startswith('<%'):
-                        code_str = elem.replace('<%', '').replace('%>', '').lstrip()
-                        #result = self.loadstring(code_str).strip()
-                        # small modification from original code to allow for spaces at the end
-                        # spaces after figures are required for figure captions with pandoc
-                        result = self.loadstring(code_str).lstrip().replace("\n","",1)
-                        splitted[i] = result
-                return ''.join(splitted)
-
-        class PwebPandocFormatterFixedFigures(PwebPandocFormatter):
-            def make_figure_string_size(self, figname, width, label, caption = ""):
-                # new function to fix figure width string to work with pandoc format
-                # only use width if pandoc installed is >= v1.16.0
-                if self.new_pandoc:
-                    figstring="![%s](%s){ width=%s }\n" % (caption, figname, width)
-                else:
-                    figstring="![%s](%s)\n" % (caption, figname) 
-                
-                if caption == "":
-                    figstring += "\\"
-        
-                figstring += "\n"
-                
-                return figstring
-
-            def formatfigure(self, chunk):
-                fignames = chunk['figure']
-                if chunk["caption"]:
-                    caption = chunk["caption"]
-                else:
-                    caption = ""
-                figstring = ""
-                
-                # increase default figure size
-                if not chunk["width"]:
-                    chunk["width"]="100%"
-        
-                if chunk['caption'] and len(fignames) > 0:
-                    if len(fignames) > 1:
-                        print("INFO: Only including the first plot in a chunk when the caption is set")
-                        figstring = self.make_figure_string_size(fignames[0], chunk["width"], chunk["name"], caption)
-                        return figstring
-        
-                for fig in fignames:
-                    # original line which duplicates figures commented out and replaced
-                    #figstring += self.make_figure_string(fignames[0], chunk["width"], chunk["name"])
-                    figstring += self.make_figure_string_size(fig, chunk["width"], chunk["name"])
-        
-                return figstring
-
         if temp_template.endswith(".py"): 
-            # capture stdout messages
-            original_stdout = sys.stdout
-            sys.stdout = capture_stdout = StringIO()
-
-            doc = Pweb(temp_template)
-            doc.setformat(Formatter = PwebPandocFormatterFixedFigures)
-            doc.detect_reader()
-            doc.weave(shell=PwebProcessorSpaces)
-        
-            sys.stdout = original_stdout
+            # discard stdout messages instead of holding them in memory
+            from pweave import Pweb
+            PwebProcessorSpaces, PwebPandocFormatterFixedFigures = _get_pweave_classes()
+            with open(os.devnull, "w") as devnull, capture(stdout=devnull):
+                doc = Pweb(temp_template)
+                doc.setformat(Formatter = PwebPandocFormatterFixedFigures)
+                doc.detect_reader()
+                doc.weave(shell=PwebProcessorSpaces)
         else:
-            sh("pweave {0} -o {1}".format(temp_template,intermediate_template),log_command=True)()
+            # weave in a child process so the template scope is separate from this process
+            # forking a process with pweave already imported is faster than running the pweave command
+            try:
+                import pweave
+                weave_process = multiprocessing.Process(target=_weave, args=(temp_template,intermediate_template,vars_environment))
+            except ImportError:
+                weave_process = None
+                
+            if weave_process:
+                weave_process.start()
+                weave_process.join()
+                if weave_process.exitcode != 0:
+                    os.chdir(current_working_directory)
+                    raise ShellException(weave_process.exitcode, "Unable to weave template: "+temp_template)
+            else:
+                pweave_environment=os.environ.copy()
+                pweave_environment.update(vars_environment)
+                sh("pweave {0} -o {1}".format(temp_template,intermediate_template),log_command=True,
+                    env=pweave_environment)()
        
         sh(pandoc_command.format(intermediate_template, temp_report),log_command=True)()          
         
@@ -324,41 +706,53 @@ class PweaveDocument(Document):
         os.chdir(current_working_directory)
         
         # rename to the original target name and location specified
-        shutil.copy(temp_report,self.targets[0])
+        # (the temp folder is in the target folder so this does not copy the report)
+        os.replace(temp_report,target_file)
         
         # move the temp figures files
-        temp_figures_folder=os.path.join(temp_directory,"figures")
-        for file in os.listdir(temp_figures_folder):
-            shutil.move(os.path.join(temp_figures_folder,file),os.path.join(self.figures_folder,file))
+        # (the temp folder is in the target folder so these are renames on the same file system)
+        for entry in os.scandir(os.path.join(temp_directory,"figures")):
+            figure_file=os.path.join(self.figures_folder,entry.name)
+            try:
+                os.rename(entry.path,figure_file)
+            except OSError:
+                # the figures folder could be linked to another file system
+                shutil.move(entry.path,figure_file)
         
         # remove all of the temp files in the temp folder
         shutil.rmtree(temp_directory,ignore_errors=True)
         
-        # remove the figures folder if it is empty
-        if len(os.listdir(self.figures_folder)) == 0:
-            os.rmdir(self.figures_folder)
-        
-        # remove the data folder if it is empty
-        if len(os.listdir(self.data_folder)) == 0:
-            os.rmdir(self.data_folder)
+        # remove the figures and data folders if they are empty
+        # (rmdir will not remove a folder that still contains files)
+        for folder in [self.figures_folder, self.data_folder]:
+            try:
+                os.rmdir(folder)
+            except OSError:
+                pass
         
         
     def get_vars(self):
-        """ Try to get the variables from the pickled file """
+        """ Try to get the variables from the environment or the pickled file """
+        
+        # small sets of variables are provided in the environment of the weave process
+        if _VARS_ENVIRONMENT_VARIABLE in os.environ:
+            return _load_vars(base64.b64decode(os.environ[_VARS_ENVIRONMENT_VARIABLE]))
         
         # the pickled file will be the same name as the template name
         # the current working directory will hold the pickle file
         # the current working directory is a temp folder
         
-        # find the pickle file
-        pickle_file = list(filter(lambda x: x.endswith(".pkl"),os.listdir(".")))
-        
-        vars = pickle.load(open(pickle_file[0],"rb"))
+        # find the pickle file, stopping at the first found
+        try:
+            pickle_file = next(entry.path for entry in os.scandir(".") if entry.name.endswith(".pkl"))
+        except StopIteration:
+            raise EOFError("Unable to find the pickled variables file")
         
-        return vars
+        with open(pickle_file,"rb") as file_handle:
+            return _load_vars(file_handle.read())
             
     
-    def read_table(self, file, invert=None, delimiter="\t", only_data_columns=None, format_data=None):
+    def read_table(self, file, invert=None, delimiter="\t", only_data_columns=None, format_data=None, as_array=None):
         """ Read the table from a text file with the first line the column
         names and the first column the row names. 
         
@@ -377,6 +771,9 @@ class PweaveDocument(Document):
         :keyword format_data: A function to use to format the data
         :type format_data: function
         
+        :keyword as_array: Return the data as a numpy array instead of a list of lists
+        :type as_array: bool
+        
         """
         
         def try_format_data(function, data):
@@ -392,47 +789,92 @@ class PweaveDocument(Document):
                 
             return formatted_data
             
+        def format_numbers(function, values):
+            """ Format the numerical values at once, returning None if any are not numbers """
+            
+            try:
+                formatted_values=numpy.array(values, dtype=str).astype(float)
+            except ValueError:
+                # some values are not numbers or the rows are not the same length
+                return None
+            
+            if function == float or numpy.isfinite(formatted_values).all():
+                return formatted_values.astype(function)
+            return None
+            
+        def format_table(function, table):
+            """ Format all of the numerical data at once, if possible """
+            
+            if function not in [float, int]:
+                return [[try_format_data(function, i) for i in row] for row in table]
+            
+            _import_plotting()
+            formatted_table=format_numbers(function, table)
+            if formatted_table is not None:
+                return formatted_table
+            
+            # format each row at once, only formatting each value for rows with values that are not numbers
+            formatted_table=[]
+            for row in table:
+                formatted_row=format_numbers(function, row)
+                if formatted_row is None:
+                    formatted_table.append([try_format_data(function, i) for i in row])
+                else:
+                    formatted_table.append(formatted_row.tolist())
+            return formatted_table
         
         # if not set, format data to floats
         if format_data is None:
             format_data=float
         
-        data=[]
-        row_names=[]
+        # read the whole file at once and split the lines in bulk
         with open(file) as file_handle:
-            column_names = file_handle.readline().rstrip().split(delimiter)[1:]
-            for line in file_handle:
-                line=line.rstrip().split(delimiter)
-                row_names.append(line[0])
-                data.append([try_format_data(format_data, i) for i in line[1:]])
+            lines=file_handle.read().split("\n")
+        # a final newline does not start another row
+        if lines[-1] == "":
+            lines.pop()
+            
+        column_names = lines[0].rstrip().split(delimiter)[1:] if lines else []
+        rows=[line.rstrip().split(delimiter) for line in lines[1:]]
+        row_names=[row[0] for row in rows]
+        data=format_table(format_data, [row[1:] for row in rows])
+        
+        # only convert back to lists if an array was not requested
+        if as_array:
+            _import_plotting()
+            data=numpy.asarray(data)
+        elif not isinstance(data, list):
+            data=data.tolist()
                 
         # remove extra columns if not requested
         if only_data_columns is not None:
             column_names=[column_names[i] for i in only_data_columns]
-            new_data=[]
-            for row in data:
-                new_data.append([row[i] for i in only_data_columns])
-            data=new_data
+            if as_array:
+                data=data[:,only_data_columns]
+            elif len(only_data_columns) > 1:
+                select_columns=operator.itemgetter(*only_data_columns)
+                data=[list(select_columns(row)) for row in data]
+            else:
+                # itemgetter does not return a tuple for a single column
+                data=[[row[i] for i in only_data_columns] for row in data]
                 
         return column_names, row_names, data
     
     def sorted_data_numerical_or_alphabetical(self, data):
         """ Sort the data numerically or alphabetically depending on data type """
 
-        # sort the data alphabetically
-        sorted_data = sorted(data)
+        # nothing to order for a single group (common for metadata)
+        if len(data) < 2:
+            return list(data)
+
+        # allow for NA in keys (these are sorted to the end)
+        values = [value for value in data if value != "NA"]
         
-        try:
-            # allow for NA in keys
-            na=False
-            if "NA" in data:
-                data.remove("NA")
-                na=True
-            sorted_data = sorted(data, key=float)
-            if na:
-                sorted_data+=["NA"]
-        except ValueError:
-            pass        
+        # only sort once, numerically if all values are numbers otherwise alphabetically
+        if all(_is_number(value) for value in values):
+            sorted_data = sorted(values, key=float) + ["NA"]*(len(data)-len(values))
+        else:
+            sorted_data = sorted(data)
         
         return sorted_data
 
@@ -442,7 +884,7 @@ class PweaveDocument(Document):
             :param color:  string
             :param label:  string
          """
-         import matplotlib.pyplot as pyplot
+         _import_plotting()
 
          pyplot.axhline(threshold, color=color)
          pyplot.text(0, int(threshold) + 50, label)
@@ -493,37 +935,40 @@ class PweaveDocument(Document):
         
         """
         
-        import numpy
-        import matplotlib.pyplot as pyplot
+        _import_plotting()
         
-        total_groups=len(grouped_data.keys())
-        figure, group_axis = pyplot.subplots(1, total_groups, sharey=True, gridspec_kw = {'wspace':0.02},figsize=(10,6),dpi=150)
+        # sort the groups prior to plotting
+        sorted_group_names = self.sorted_data_numerical_or_alphabetical(list(grouped_data))
+            
+        # get the total number of columns for all groups
+        total_columns_all_groups=sum(len(labels) for labels in column_labels_grouped.values())
 
         # create a set of custom colors to prevent overlap
         # get only a set number of items to recycle colors through subplots
         custom_colors=list(itertools.islice(self._custom_colors(total_colors=len(row_labels)),len(row_labels)))
 
+        figure, group_axis = pyplot.subplots(1, len(sorted_group_names), sharey=True, gridspec_kw = {'wspace':0.02},figsize=(10,6),dpi=150)
+
+        # groups with the same number of columns share the bar positions
+        plot_indexes_by_size={}
+
         # create a subplot for each group
-        group_number=0
-        
-        # sort the groups prior to plotting
-        sorted_group_names = self.sorted_data_numerical_or_alphabetical(list(grouped_data.keys()))
-            
-        # get the total number of columns for all groups
-        total_columns_all_groups=len(list(itertools.chain.from_iterable(column_labels_grouped.values())))
-        
-        for group_name in sorted_group_names:
+        for group_number, group_name in enumerate(sorted_group_names):
             data = grouped_data[group_name]
             bar_plots=[]
             # create a plot for each stacked group
             column_labels=column_labels_grouped[group_name]
-            plot_indexes=numpy.arange(len(column_labels))
-            y_offset=numpy.array([0.0]*len(column_labels))
-            for plot_abundance, color in zip(data, custom_colors):
+            if len(column_labels) not in plot_indexes_by_size:
+                plot_indexes_by_size[len(column_labels)]=numpy.arange(len(column_labels))
+            plot_indexes=plot_indexes_by_size[len(column_labels)]
+            # the bottom of each stacked plot is the sum of the plots below it
+            # (summed directly into the offsets to skip a temporary array)
+            data=numpy.asarray(data, dtype=float)
+            y_offsets=numpy.zeros_like(data)
+            numpy.cumsum(data[:-1], axis=0, out=y_offsets[1:])
+            for plot_abundance, y_offset, color in zip(data, y_offsets, custom_colors):
                 bar_plots.append(group_axis[group_number].bar(plot_indexes, plot_abundance, 
                     bottom=y_offset, align="center", color=color))
-                # add to the y_offset which is the bottom of the stacked plot
-                y_offset=y_offset+plot_abundance
             
             # set the current axis to this groups plot
             pyplot.sca(group_axis[group_number])    
@@ -537,11 +982,9 @@ class PweaveDocument(Document):
                 figure.subplots_adjust(bottom=0.3)
                 pyplot.xticks(plot_indexes, column_labels, fontsize=7, rotation="vertical")
             else:
-                pyplot.tick_params(axis="x",which="both",bottom="off",labelbottom="off")
+                pyplot.tick_params(axis="x",which="both",bottom=False,labelbottom=False)
                 pyplot.xticks([])
             pyplot.yticks(fontsize=7)
-            
-            group_number+=1
            
         pyplot.tight_layout()
  
@@ -562,7 +1005,7 @@ class PweaveDocument(Document):
         if outfilename:
             pyplot.savefig(outfilename)
             print("\n\n![]("+outfilename+"){#id .class width=675px height=405px}\n\n")
-            pyplot.close()
+            pyplot.close(figure)
         else:
             pyplot.draw() 
 
@@ -596,31 +1039,29 @@ class PweaveDocument(Document):
         
         """
         
-        import numpy
-        import matplotlib.pyplot as pyplot
-        import matplotlib.ticker as ticker
+        _import_plotting()
         
         # create a figure subplot to move the legend
-        figure = pyplot.figure(figsize=(10,6),dpi=150)
-        subplot=pyplot.subplot(111)
+        figure = _get_figure(outfilename, figsize=(10,6), dpi=150)
+        subplot=figure.add_subplot(111)
         
         # create a set of custom colors to prevent overlap
         custom_colors=self._custom_colors(total_colors=len(row_labels))
         
         # change the yaxis format if set
-        axis = pyplot.gca()
         if yaxis_in_millions:
             # get the max value to determine if decimals should be shown on the label 
             max_value=max([max(row)for row in data])/1000000.0
+            # select the format once so each tick only scales and formats the value
             if max_value <= 0.5:
-                yaxis_format = lambda value, position: "{:,.3f}".format(float(value/1000000.0))
+                yaxis_format = "{:,.3f}".format
             elif max_value <= 1:
-                yaxis_format = lambda value, position: "{:,.2f}".format(float(value/1000000.0))
+                yaxis_format = "{:,.2f}".format
             elif max_value <= 5:
-                yaxis_format = lambda value, position: "{:,.1f}".format(float(value/1000000.0))
+                yaxis_format = "{:,.1f}".format
             else:
-                yaxis_format = lambda value, position: "{:,}".format(int(value/1000000))
-            axis.get_yaxis().set_major_formatter(ticker.FuncFormatter(yaxis_format))
+                yaxis_format = lambda value: "{:,}".format(int(value))
+            subplot.get_yaxis().set_major_formatter(matplotlib.ticker.FuncFormatter(lambda value, position: yaxis_format(value/1000000.0)))
         
         # set the width of the bars as each total group width is one
         bar_start_point = numpy.arange(len(column_labels))
@@ -628,29 +1069,32 @@ class PweaveDocument(Document):
         bar_width = (1.0 - gap) / len(data)
         
         # create the grouped barplots with gap offsets
+        # compute the positions of the bars for all of the data sets at once
+        bar_positions = bar_start_point + numpy.arange(len(data))[:,None]*bar_width
         barplots=[]
-        for i, data_set in enumerate(data):
-            barplots.append(subplot.bar(bar_start_point + i*bar_width, data_set,
+        for positions, data_set in zip(bar_positions, numpy.asarray(data)):
+            barplots.append(subplot.bar(positions, data_set,
                 width=bar_width, color=next(custom_colors)))   
         
         # add labels and title
         if xlabel is not None and len(column_labels) <= self.max_labels:
-            pyplot.xlabel(xlabel)
+            subplot.set_xlabel(xlabel)
         if ylabel is not None:
-            pyplot.ylabel(ylabel)
+            subplot.set_ylabel(ylabel)
             
-        pyplot.title(title)
+        subplot.set_title(title)
         
         # place the xticks in the middle of each group
         if len(column_labels) <= self.max_labels:
             # move the bottom of the figure for larger xaxis labels
             # done first before adjusting the width of the figure
             figure.subplots_adjust(bottom=0.3) 
-            pyplot.xticks(bar_start_point + 0.5, column_labels, fontsize=7, rotation="vertical")
+            subplot.set_xticks(bar_start_point + 0.5)
+            subplot.set_xticklabels(column_labels, fontsize=7, rotation="vertical")
         else:
-            pyplot.tick_params(axis="x",which="both",bottom="off",labelbottom="off")
-            pyplot.xticks([])
-        pyplot.yticks(fontsize=7)
+            subplot.tick_params(axis="x",which="both",bottom=False,labelbottom=False)
+            subplot.set_xticks([])
+        subplot.tick_params(axis="y", labelsize=7)
         
         # reduce the size of the plot to fit in the legend
         subplot_position=subplot.get_position()
@@ -661,9 +1105,8 @@ class PweaveDocument(Document):
             fontsize=8, title=legend_title, frameon=False)
         
         if outfilename:
-            pyplot.savefig(outfilename)
+            figure.savefig(outfilename)
             print("\n\n![]("+outfilename+"){#id .class width=675px height=405px}\n\n")
-            pyplot.close()
         else:
             pyplot.draw()
         
@@ -690,8 +1133,7 @@ class PweaveDocument(Document):
         
         """
         
-        import numpy
-        import matplotlib.pyplot as pyplot
+        _import_plotting()
         
         # create a figure subplot to move the legend
         figure = pyplot.figure()
@@ -703,11 +1145,11 @@ class PweaveDocument(Document):
             plots.append(subplot.scatter(x,y))
             
             if trendline:
-                # compute linear least squares polynomial fit, returns vector of coefficients
-                coeff = numpy.polyfit(x,y,1)
-                trendline_function = numpy.poly1d(coeff)
+                # compute the linear least squares fit directly instead of a general polynomial fit
+                x = numpy.asarray(x, dtype=float)
+                slope, intercept = _linear_fit(x, numpy.asarray(y, dtype=float))
                 # add trendline to the plot
-                pyplot.plot(x,trendline_function(x))
+                pyplot.plot(x,slope*x+intercept)
         if ylabel:
             pyplot.ylabel(ylabel)
         if xlabel:
@@ -745,8 +1187,7 @@ class PweaveDocument(Document):
         
         """
         
-        import numpy
-        import matplotlib.pyplot as pyplot
+        _import_plotting()
         
         figure = pyplot.figure()
         
@@ -780,22 +1221,16 @@ class PweaveDocument(Document):
     def _custom_colors(self,total_colors):
         """ Get a set of custom colors for a matplotlib plot """
         
-        from matplotlib import cm
-
         # create a set of custom colors
         # get the max amount of colors for a few different color maps
-        tab10=[cm.tab10(i/10.0) for i in range(10)]
-        tab20=[cm.tab20(i/20.0) for i in range(20)]
-        tab20b=[cm.tab20b(i/20.0) for i in range(20)]
-        tab20c=[cm.tab20c(i/20.0) for i in range(20)]
-        
         if total_colors <= 20:
-            sets=tab20
+            sets=_colormap_colors("tab20",20)
         else:
-            sets=tab20c+tab20b
+            if "tab20c+tab20b" not in _colormaps:
+                _colormaps["tab20c+tab20b"]=_colormap_colors("tab20c",20)+_colormap_colors("tab20b",20)
+            sets=_colormaps["tab20c+tab20b"]
        
-        for color in itertools.cycle(sets):
-            yield color
+        return itertools.cycle(sets)
   
 
     def plot_stacked_barchart(self, data, row_labels, column_labels, title,
@@ -834,11 +1269,10 @@ class PweaveDocument(Document):
         
         """
         
-        import numpy
-        import matplotlib.pyplot as pyplot
+        _import_plotting()
         
-        figure = pyplot.figure(figsize=(10,6),dpi=150)
-        subplot=pyplot.subplot(111)
+        figure = _get_figure(outfilename, figsize=(10,6), dpi=150)
+        subplot=figure.add_subplot(111)
         bar_plots=[]
         names=[]
         
@@ -847,13 +1281,14 @@ class PweaveDocument(Document):
         
         # create a plot for each stacked group
         plot_indexes=numpy.arange(len(column_labels))
-        y_offset=numpy.array([0.0]*len(column_labels))
-        for name, plot_abundance, color in zip(row_labels, data, custom_colors):
+        # the bottom of each stacked plot is the sum of the plots below it
+        data=numpy.asarray(data, dtype=float)
+        y_offsets=numpy.zeros_like(data)
+        y_offsets[1:]=numpy.cumsum(data[:-1], axis=0)
+        for name, plot_abundance, y_offset, color in zip(row_labels, data, y_offsets, custom_colors):
             bar_plots.append(subplot.bar(plot_indexes, plot_abundance, 
                 bottom=y_offset, align="center", color=color))
             names.append(name)
-            # add to the y_offset which is the bottom of the stacked plot
-            y_offset=y_offset+plot_abundance
             
         # Add the title, labels, and legend
         if xlabel is not None and len(column_labels) <= self.max_labels:
@@ -861,26 +1296,27 @@ class PweaveDocument(Document):
         if ylabel is not None:
             subplot.set_ylabel(ylabel)
             
-        pyplot.title(title)
+        subplot.set_title(title)
         
         if len(column_labels) <= self.max_labels:
             # move the bottom of the figure for larger xaxis labels
             # done first before adjusting the width of the figure
             figure.subplots_adjust(bottom=0.3)
             # add labels
-            pyplot.xticks(plot_indexes, column_labels, fontsize=7, rotation="vertical")
+            subplot.set_xticks(plot_indexes)
+            subplot.set_xticklabels(column_labels, fontsize=7, rotation="vertical")
         else:
-            pyplot.tick_params(axis="x",which="both",bottom="off",labelbottom="off")
-            pyplot.xticks([])
+            subplot.tick_params(axis="x",which="both",bottom=False,labelbottom=False)
+            subplot.set_xticks([])
        
-        pyplot.tight_layout()
+        figure.tight_layout()
  
         # reduce the size of the plot to fit in the legend
         subplot_position=subplot.get_position()
         subplot.set_position([subplot_position.x0, subplot_position.y0, 
             subplot_position.width *0.65, subplot_position.height])
             
-        pyplot.yticks(fontsize=7)
+        subplot.tick_params(axis="y", labelsize=7)
         if legend_reverse:
             subplot.legend(list(reversed(bar_plots)),self.add_ellipse(list(reversed(names))),loc="center left", bbox_to_anchor=(1,0.5),
                 title=legend_title, frameon=False, prop={"size":legend_size, "style":legend_style})
@@ -889,9 +1325,8 @@ class PweaveDocument(Document):
                 title=legend_title, frameon=False, prop={"size":legend_size, "style":legend_style})
       
         if outfilename:
-            pyplot.savefig(outfilename)
+            figure.savefig(outfilename)
             print("\n\n![]("+outfilename+"){#id .class width=675px height=405px}\n\n")
-            pyplot.close()
         else: 
             pyplot.draw()
         
@@ -922,23 +1357,24 @@ class PweaveDocument(Document):
         
         """
         
-        import numpy
-        import matplotlib.pyplot as pyplot
-        from matplotlib.table import Table
+        _import_plotting()
 
         # if the option is set to format the data, add commas
         if format_data_comma:
-            format_data = [list(map(lambda x: "{:,}".format(int(x)),row)) for row in data]
+            data=numpy.array([["{:,}".format(int(value)) for value in row] for row in data], dtype=str)
         else:
-            format_data = [list(map(str,row)) for row in data]
-        data=format_data
+            data=numpy.asarray(data)
+            # only convert values which are not already strings
+            if data.dtype.kind != "U":
+                data=data.astype(object).astype(str)
         
         # create a figure in one subplot
-        figure, axis = pyplot.subplots()
+        figure = _get_figure(outfilename)
+        axis = figure.add_subplot(111)
         axis.set_axis_off()
         
         # create a new table instance
-        table = Table(axis, bbox=[0,0,1,1])
+        table = matplotlib.table.Table(axis, bbox=[0,0,1,1])
     
         total_rows=len(row_labels)
         total_columns=len(column_labels)
@@ -947,27 +1383,32 @@ class PweaveDocument(Document):
     
         # get the width of the columns based on
         # the length of the labels and values
-        max_width_chars = [max(map(len,row_labels))]
-        for i in range(total_columns):
-            current_values=[str(value) for value in [column_labels[i]]+[row[i] for row in data]]
-            max_width_chars.append(max(list(map(len,current_values))))
+        max_width_chars = numpy.maximum(numpy.char.str_len(numpy.array(column_labels, dtype=str)),
+            numpy.char.str_len(data).max(axis=0))
+        max_width_chars = numpy.insert(max_width_chars, 0, max(map(len,row_labels)))
         
         # compute the widths for each column
-        total_chars=sum(max_width_chars)*1.0
-        column_widths=[i/total_chars for i in max_width_chars]
+        column_widths=(max_width_chars/float(max_width_chars.sum())).tolist()
+    
+        # look up the method once since it is called for every cell
+        add_cell=table.add_cell
+    
+        # the data columns start after the row labels column
+        data_column_widths=column_widths[1:]
     
         # add column labels
-        for i, label in enumerate(column_labels):
-            table.add_cell(0, i+1, width=column_widths[i+1], height=height, text=label, loc=location)
+        for j, (label, width) in enumerate(zip(column_labels, data_column_widths), start=1):
+            add_cell(0, j, width=width, height=height, text=label, loc=location)
     
         # add row labels
-        for i, label in enumerate(row_labels):
-            table.add_cell(i+1, 0, width=column_widths[0], height=height, text=label, loc=location)
+        row_label_width=column_widths[0]
+        for i, label in enumerate(row_labels, start=1):
+            add_cell(i, 0, width=row_label_width, height=height, text=label, loc=location)
     
         # Add data
-        for i, row in enumerate(data):
-            for j, value in enumerate(row):
-                table.add_cell(i+1, j+1, width=column_widths[j+1], height=height, text=value, loc=location)               
+        for i, row in enumerate(data, start=1):
+            for j, (value, width) in enumerate(zip(row, data_column_widths), start=1):
+                add_cell(i, j, width=width, height=height, text=value, loc=location)
 
         axis.add_table(table)
 
@@ -985,15 +1426,48 @@ class PweaveDocument(Document):
         table.set_fontsize(font_size)
     
         # add the title
-        pyplot.title(title)
+        axis.set_title(title)
 
         if outfilename:
-            pyplot.savefig(outfilename)
+            figure.savefig(outfilename)
             print("\n\n![]("+outfilename+"){#id .class width=675px height=405px}\n\n")
-            pyplot.close()
         else:
             pyplot.draw()
  
+    def show_table_markdown(self, data, row_labels, column_labels, title, format_data_comma=None):
+        """ Print the data as a markdown table which pandoc includes as text
+        (instead of drawing an image of the table). Use in a chunk with 
+        the results set to markdown.
+        
+        :param data: A list of lists containing the data
+        :type data: list
+        
+        :param row_labels: The labels for the data rows
+        :type row_labels: list
+        
+        :param column_labels: The labels for the columns
+        :type column_labels: list
+        
+        :param title: The title for the table
+        :type title: str
+        
+        :keyword format_data_comma: Format the data as comma delimited
+        :type format_data_comma: bool
+        
+        """
+        
+        def format_row(values):
+            # pipes in the values would start new columns
+            return "| "+" | ".join(str(value).replace("|","\\|") for value in values)+" |"
+        
+        if format_data_comma:
+            data=[["{:,}".format(int(value)) for value in row] for row in data]
+        
+        lines=[format_row([" "]+list(column_labels)), "|"+"---|"*(len(column_labels)+1)]
+        lines+=[format_row([label]+list(row)) for label, row in zip(row_labels, data)]
+        
+        print("\n\n"+"\n".join(lines)+"\n\nTable: "+title+"\n\n")
+ 
     def write_table(self, column_labels, row_labels, data, file):
         """ Write a table of data to a file 
         
@@ -1012,13 +1486,16 @@ class PweaveDocument(Document):
         """
         
         # if the folder for the table does not exist, then create
-        if not os.path.isdir(os.path.dirname(file)):
-            os.makedirs(os.path.dirname(file))
+        # (a file in the current working directory does not have a folder)
+        if os.path.dirname(file):
+            mkdirp(os.path.dirname(file))
+    
+        _import_plotting()
     
+        # use an object array so the values are written as str() would format them
+        table=numpy.column_stack([numpy.array(row_labels, dtype=object), numpy.array(data, dtype=object)])
         with open(file, "w") as file_handle:
-            file_handle.write("\t".join(column_labels)+"\n")
-            for name, row in zip(row_labels, data):
-                file_handle.write("\t".join([name]+[str(i) for i in row])+"\n")
+            numpy.savetxt(file_handle, table, fmt="%s", delimiter="\t", header="\t".join(column_labels), comments="")
         
     def show_hclust2(self,sample_names,feature_names,data,title,log_scale=True,zscore=False,metadata_rows=None,method="correlation",outfilename=None):
         """ Create a hclust2 heatmap with dendrogram and show it in the document
@@ -1051,18 +1528,28 @@ class PweaveDocument(Document):
         :type method: str
         """
         
-        import matplotlib.pyplot as pyplot
-        import numpy
+        _import_plotting()
         
         # apply zscore if requested
         if zscore:
-            from scipy import stats
-
             total_metadata=len(metadata_rows) if metadata_rows else 0
-            data[total_metadata:] = stats.zscore(numpy.array(data[total_metadata:]),axis=1).tolist()
+            
+            # compute the zscores in place (rows with no variance are set to zero)
+            zscores=numpy.array(data[total_metadata:],dtype=float)
+            zscores-=zscores.mean(axis=1,keepdims=True)
+            deviation=zscores.std(axis=1,keepdims=True)
+            numpy.divide(zscores,deviation,out=zscores,where=deviation!=0)
+            data[total_metadata:] = zscores
+        
+        # without metadata the heatmap can be drawn in this process
+        # hclust2 is only required to add the metadata rows to the heatmap
+        if not metadata_rows:
+            self._show_clustered_heatmap(sample_names,feature_names,data,title,log_scale,method,outfilename)
+            return
         
         # write a file of the data
-        handle, hclust2_input_file=tempfile.mkstemp(prefix="hclust2_input",dir=os.getcwd())
+        handle, hclust2_input_file=tempfile.mkstemp(prefix="hclust2_input",dir=_get_temp_directory())
+        os.close(handle)
         # if output file is provided, use that instead
         if outfilename:
             heatmap_file=outfilename
@@ -1085,12 +1572,7 @@ class PweaveDocument(Document):
         aspect_ratio=len(sample_names)/(len(feature_names)*1.0)
 
         # check for hclust executable
-        exe_name = "hclust2"
-        try:
-            with open(os.devnull, 'w') as devnull:
-                out=subprocess.check_call("which hclust2", shell=True, stderr=devnull, stdout=devnull)
-        except subprocess.CalledProcessError:
-            exe_name = "hclust2.py"
+        exe_name = "hclust2" if find_on_path("hclust2") else "hclust2.py"
 
         command=[exe_name,"-i",hclust2_input_file,"-o",heatmap_file,"--title",title,
             "--title_font",str(int(label_font)*2),"--cell_aspect_ratio",str(aspect_ratio),
@@ -1116,13 +1598,15 @@ class PweaveDocument(Document):
         if len(feature_names) > self.max_labels:
             command+=["--no_flabels"]
            
+        heatmap=[]
         try: 
             output=subprocess.check_output(command)
-            # read the heatmap png file
-            heatmap=pyplot.imread(heatmap_file)
+            # read the heatmap png file only if it is drawn in the document
+            # (an output file is linked in the document as written by hclust2)
+            if not outfilename:
+                heatmap=_read_image(heatmap_file)
         except (subprocess.CalledProcessError, OSError):
             print("Unable to generate heatmap.")
-            heatmap=[]
 
         # if the output file is provided, then just print out a link to it in the doc
         if outfilename:
@@ -1136,40 +1620,133 @@ class PweaveDocument(Document):
 
             fig = pyplot.figure(figsize=(6,6),dpi=dpi)
 
-            if metadata_rows:
-                subplot1 = pyplot.subplot2grid((4,1),(0,0), rowspan=3, frame_on=False)
-                subplot1.xaxis.set_visible(False)
-                subplot1.yaxis.set_visible(False)
-            else:
-                subplot = fig.add_subplot(111, frame_on=False)
-                subplot.xaxis.set_visible(False)
-                subplot.yaxis.set_visible(False)
+            # heatmap subplot (this is only drawn from the hclust2 image with metadata rows)
+            subplot1 = pyplot.subplot2grid((4,1),(0,0), rowspan=3, frame_on=False)
+            subplot1.xaxis.set_visible(False)
+            subplot1.yaxis.set_visible(False)
             # show but do not interpolate (as this will make the text hard to read)
-            pyplot.imshow(heatmap, interpolation="none")
+            subplot1.imshow(heatmap, interpolation="none")
 
-            if metadata_rows:
-                heatmap_legend = pyplot.imread(metadata_legend_file)
-                # metadata legend subplot
-                subplot2 = pyplot.subplot2grid((4,1),(3,0), rowspan=1, frame_on=False)
-                subplot2.xaxis.set_visible(False)
-                subplot2.yaxis.set_visible(False)
-                pyplot.imshow(heatmap_legend, interpolation="none")
+            heatmap_legend = _read_image(metadata_legend_file)
+            # metadata legend subplot
+            subplot2 = pyplot.subplot2grid((4,1),(3,0), rowspan=1, frame_on=False)
+            subplot2.xaxis.set_visible(False)
+            subplot2.yaxis.set_visible(False)
+            subplot2.imshow(heatmap_legend, interpolation="none")
 
-            pyplot.draw()
-            # adjust the heatmap to fit in the figure area
+            # adjust the heatmap to fit in the figure area before it is drawn
             # this is needed to increase the image size (to fit in the increased figure)
-            pyplot.tight_layout()
+            fig.tight_layout()
+            pyplot.draw()
+            
+        # remove the temp files (the images are only temp files if an output file is not provided)
+        temp_files=[hclust2_input_file]
+        if not outfilename:
+            temp_files+=[heatmap_file, metadata_legend_file]
+        for file in temp_files:
+            try:
+                os.remove(file)
+            except OSError:
+                pass
+        
+    def _cluster(self, data, method):
+        """ Hierarchically cluster the rows of the data returning the linkage and leaf order """
+        
+        _import_plotting()
+        from scipy.cluster import hierarchy
+        from scipy.spatial.distance import pdist
+        
+        if len(data) < 2:
+            return None, list(range(len(data)))
+        
+        # constant rows have undefined distances for some functions (ie correlation)
+        distances=numpy.nan_to_num(pdist(data, metric=method))
+        linkage=hierarchy.linkage(distances, method="average")
+        
+        return linkage, hierarchy.leaves_list(linkage).tolist()
+    
+    def _show_clustered_heatmap(self, sample_names, feature_names, data, title, log_scale, method, outfilename):
+        """ Draw a heatmap with dendrograms for the samples and features """
+        
+        _import_plotting()
+        from scipy.cluster import hierarchy
+        
+        label_font=8
+        data=numpy.array(data,dtype=float)
+        
+        # cluster the samples with bray-curtis (as is the default for hclust2)
+        # and the features with the distance function provided
+        sample_linkage, sample_order=self._cluster(data.T, "braycurtis")
+        feature_linkage, feature_order=self._cluster(data, method)
+        data=data[feature_order][:,sample_order]
+        
+        figure=_get_figure(outfilename, figsize=(6,6), dpi=150)
+        heatmap_axis=figure.add_axes([0.22,0.2,0.58,0.6])
+        
+        # add the dendrograms above and to the left of the heatmap
+        for linkage, position, orientation in [(sample_linkage,[0.22,0.8,0.58,0.1],"top"),
+            (feature_linkage,[0.02,0.2,0.2,0.6],"left")]:
+            if linkage is not None:
+                dendrogram_axis=figure.add_axes(position, frame_on=False)
+                hierarchy.dendrogram(linkage, ax=dendrogram_axis, orientation=orientation, no_labels=True,
+                    color_threshold=0, above_threshold_color="black")
+                dendrogram_axis.set_xticks([])
+                dendrogram_axis.set_yticks([])
+        
+        # only use the log scale if the data is positive (zscores can be negative)
+        norm=None
+        colormap="YlOrRd"
+        if log_scale and data.min() >= 0 and data.max() > 0:
+            min_positive=data[data > 0].min()
+            data=numpy.clip(data, min_positive, None)
+            norm=matplotlib.colors.LogNorm(vmin=min_positive, vmax=data.max())
+        elif data.min() < 0:
+            colormap="RdBu_r"
+        
+        # the features are plotted from the bottom to match the dendrogram leaf order
+        image=heatmap_axis.imshow(data, aspect="auto", origin="lower", interpolation="none", cmap=colormap, norm=norm)
+        
+        # if more than the max samples or features, do not include the labels on the heatmap
+        if len(sample_names) <= self.max_labels:
+            heatmap_axis.set_xticks(range(len(sample_order)))
+            heatmap_axis.set_xticklabels(self.add_ellipse([sample_names[i] for i in sample_order]),
+                rotation="vertical", fontsize=label_font)
+        else:
+            heatmap_axis.set_xticks([])
+        if len(feature_names) <= self.max_labels:
+            heatmap_axis.yaxis.tick_right()
+            heatmap_axis.set_yticks(range(len(feature_order)))
+            heatmap_axis.set_yticklabels(self.add_ellipse([feature_names[i] for i in feature_order]),
+                fontsize=label_font)
+        else:
+            heatmap_axis.set_yticks([])
+            
+        colorbar_axis=figure.add_axes([0.02,0.85,0.15,0.02])
+        colorbar=figure.colorbar(image, cax=colorbar_axis, orientation="horizontal")
+        colorbar.ax.tick_params(labelsize=label_font-2)
+        
+        figure.suptitle(title, fontsize=label_font*2)
+        
+        if outfilename:
+            figure.savefig(outfilename)
+            print("\n\n![]("+outfilename+"){#id .class width=540px height=405px}\n\n")
+        else:
+            pyplot.draw()
         
     def _run_r(self, commands, args=None):
-        """ Run R on the commands providing the arguments """
+        """ Run R on the commands providing the arguments, raising an error if R fails """
         
         if args is None:
             args=[]
         
-        proc=subprocess.Popen(["R","--vanilla","--quiet","--args"]+args,
-            stdin=subprocess.PIPE, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-
-        out, err = proc.communicate(input=bytearray("\n".join(commands),'utf-8'))
+        with _r_lock:
+            robjects = _import_rpy2()
+            if robjects:
+                # run in this process instead of piping the commands to the R session
+                robjects.r("\n".join(_RSession.script(commands, args)))
+            else:
+                # use the shared session to only start R once
+                _RSession.singleton().run(commands, args)
         
     def filter_zero_rows(self, row_names, data):
         """ Filter the rows from the data set that sum to zero 
@@ -1181,13 +1758,16 @@ class PweaveDocument(Document):
         :type data: list    
         
         """
-         
-        new_names=[]
-        new_data=[]
-        for name, row in zip(row_names, data):
-            if sum(row) != 0:
-                new_names.append(name)
-                new_data.append(row)
+        
+        if len(data) == 0:
+            return [], []
+        
+        _import_plotting()
+        
+        # sum all of the rows at once and keep the original rows which are not zero
+        keep=numpy.asarray(data, dtype=float).sum(axis=1) != 0
+        new_names=[name for name, keep_row in zip(row_names, keep) if keep_row]
+        new_data=[row for row, keep_row in zip(data, keep) if keep_row]
             
         return new_names, new_data
     
@@ -1202,19 +1782,23 @@ class PweaveDocument(Document):
         
         """
 
-        import numpy
-         
-        new_names, new_data = self.filter_zero_rows(column_names, numpy.transpose(data))
-        data_temp = []
-        for row in numpy.transpose(new_data):
-            data_temp.append(list(row))
-            
-        new_data = data_temp
+        if len(data) == 0:
+            return [], []
+        
+        _import_plotting()
+        
+        # select the columns which do not sum to zero without transposing the data
+        data=numpy.asarray(data)
+        keep=data.sum(axis=0) != 0
+        if not keep.any():
+            return [], []
+        new_names=[name for name, keep_column in zip(column_names, keep) if keep_column]
+        new_data=data[:,keep].tolist()
             
         return new_names, new_data
        
     def compute_pcoa(self, sample_names, feature_names, data, apply_transform):
-        """ Use the vegan package in R to compute a PCoA. 
+        """ Compute a PCoA from the Bray-Curtis dissimilarities between samples. 
         Input data should be organized with samples as columns and features as rows. 
         Data should be scaled to [0-1] if transform is to be applied.
         
@@ -1231,18 +1815,47 @@ class PweaveDocument(Document):
         :type apply_transform: bool
         """
 
-        r_vegan_pcoa=[
-            "library(vegan)",
-            "args<-commandArgs(TRUE)",
-            "data<-read.table(args[1],sep='\\t',header=TRUE, row.names=1)",
-            "data.t<-as.data.frame(t(data))"]
-        if apply_transform:
-            r_vegan_pcoa+=["pcoa<-capscale(asin(sqrt(data.t))~1,distance='bray')"]
-        else:
-            r_vegan_pcoa+=["pcoa<-capscale(data.t~1,distance='bray')"]
-        r_vegan_pcoa+=[
-            "write.table(head(eigenvals(pcoa)/sum(eigenvals(pcoa))),args[2],sep='\\t')",
-            "write.table(as.data.frame(scores(pcoa,display='sites')),args[3],sep='\\t')"]
+        data, cache_key = self._pcoa_input(sample_names, feature_names, data, apply_transform)
+
+        # reuse the coordinates if the same data was just used for another plot
+        # or wait for the coordinates if they are being computed in the background
+        if cache_key not in _pcoa_cache:
+            pending=_pcoa_pending.pop(cache_key, None)
+            _pcoa_cache[cache_key]=pending.result() if pending else _pcoa_coordinates(data, apply_transform)
+            # only keep the most recent results
+            while len(_pcoa_cache) > _PCOA_CACHE_SIZE:
+                _pcoa_cache.popitem(last=False)
+
+        pcoa_data, pcoa1_x_label, pcoa2_y_label=_pcoa_cache[cache_key]
+        return [list(row) for row in pcoa_data], pcoa1_x_label, pcoa2_y_label
+
+    def prefetch_pcoa(self, sample_names, feature_names, data, apply_transform):
+        """ Start computing a PCoA in the background so it is ready when plotted.
+        The arguments are the same as for compute_pcoa. Call this before
+        drawing other plots and the computation will run while they are drawn.
+        
+        :param sample_names: The labels for the columns
+        :type sample_names: list
+
+        :param feature_names: The labels for the data rows
+        :type feature_names: list
+
+        :param data: A list of lists containing the data
+        :type data: list
+        
+        :keyword apply_transform: Arcsin transform to be applied
+        :type apply_transform: bool
+        """
+        
+        data, cache_key = self._pcoa_input(sample_names, feature_names, data, apply_transform)
+        
+        if cache_key not in _pcoa_cache and cache_key not in _pcoa_pending:
+            _pcoa_pending[cache_key]=_get_pcoa_executor().submit(_pcoa_coordinates, data, apply_transform)
+
+    def _pcoa_input(self, sample_names, feature_names, data, apply_transform):
+        """ Check the PCoA input returning the data as an array and the key for the results """
+        
+        _import_plotting()
         
         # test that the data is scaled to [0-1]
         if apply_transform:
@@ -1264,54 +1877,16 @@ class PweaveDocument(Document):
         if len(data) != len(feature_names):
             raise ValueError("Provide data to the AnADAMA2 document.show_pcoa function in the form of features as rows.")
         
-        # remove any samples from the data for which all features are zero
-        sample_names, data = self.filter_zero_columns(sample_names, data)
+        # convert once to the array used to compute the coordinates and the key for the results
+        data=numpy.ascontiguousarray(data,dtype=float)
 
-        # remove any features from the data for which all samples have zero values
-        feature_names, data = self.filter_zero_rows(feature_names, data)
-
-        # write a file of the data
-        handle, vegan_input_file=tempfile.mkstemp(prefix="vegan_input",dir=os.getcwd())
-        eigenvalues_file=vegan_input_file+".eigen"
-        scores_file=vegan_input_file+".scores"
-        self.write_table(["# "]+sample_names,feature_names,data,vegan_input_file)
-        
-        self._run_r(r_vegan_pcoa,[vegan_input_file,eigenvalues_file,scores_file])
+        cache_key=(hashlib.sha1(data.tobytes()).hexdigest(), data.shape, tuple(sample_names),
+            tuple(feature_names), bool(apply_transform))
         
-        # get the x and y labels
-        r_run_error=False
-        try:
-            columns, rows, data = self.read_table(eigenvalues_file)
-        except EnvironmentError:
-            print("No eigenvalues found")
-            data=[[0],[0]]
-            r_run_error=True
-        pcoa1_x_label=int(data[0][0]*100)
-        pcoa2_y_label=int(data[1][0]*100)
-        
-        # get the scores to plot
-        try:
-            columns, rows, pcoa_data = self.read_table(scores_file)
-        except EnvironmentError:
-            print("No scores found")
-            r_run_error=True
-            columns=[]
-            rows=[]
-            pcoa_data=[]
-       
-        # if there were no errors, remove the temp files
-        if not r_run_error:
-            try:
-                os.remove(vegan_input_file)
-                os.remove(eigenvalues_file)
-                os.remove(scores_file)
-            except EnvironmentError:
-                print("Warning: Unable to remove temp files")
-
-        return pcoa_data, pcoa1_x_label, pcoa2_y_label
+        return data, cache_key
             
     def show_pcoa_multiple_plots(self, sample_names, feature_names, data, title, abundances, legend_title="% Abundance", sample_types="samples", feature_types="species", apply_transform=False):
-        """ Use the vegan package in R plus matplotlib to plot a PCoA. 
+        """ Use matplotlib to plot a PCoA. 
         Input data should be organized with samples as columns and features as rows. 
         Data should be scaled to [0-1] if transform is to be applied.
         Show multiple PCoA plots as subplots each with coloring based on abundance.
@@ -1344,31 +1919,28 @@ class PweaveDocument(Document):
         :type apply_transform: bool
         """
 
-        import numpy
-        import matplotlib.pyplot as pyplot
-        from matplotlib import cm
+        _import_plotting()
 
         pcoa_data, pcoa1_x_label, pcoa2_y_label=self.compute_pcoa(sample_names, feature_names, data, apply_transform)         
  
-        # create a figure and subplots
-        nrows = len(abundances.keys())/2
-        figure, axis = pyplot.subplots(nrows=nrows,ncols=2)
-        # if needed, modify matrix of axis to list
-        reformatted_axis = []
-        if isinstance(axis[0],numpy.ndarray):
-            for axis_list in axis:
-                reformatted_axis+=axis_list.tolist()
-            axis=reformatted_axis
+        # create a figure and subplots, with two subplots per row
+        # (use integer division so an odd number of abundances has its own row)
+        nrows = (len(abundances)+1)//2
+        figure, axis = pyplot.subplots(nrows=nrows,ncols=2,squeeze=False)
+        axis = axis.ravel().tolist()
+        # hide the extra subplot for an odd number of abundances
+        for subplot in axis[len(abundances):]:
+            subplot.set_axis_off()
         figure.suptitle(title,fontsize=12,y=1.002)      
  
-        x_values = [x for x,y in pcoa_data]
-        y_values = [y for x,y in pcoa_data]
+        # get the coordinates and color values as arrays once for all of the subplots
+        x_values, y_values = numpy.asarray(pcoa_data, dtype=float).reshape(-1, 2).T
         for subplot, abundance_name in zip(axis,sorted(abundances.keys())):
-            pcoa_plot=subplot.scatter(x_values,y_values,c=abundances[abundance_name],cmap=cm.jet)
+            pcoa_plot=subplot.scatter(x_values,y_values,c=numpy.asarray(abundances[abundance_name]),cmap=matplotlib.cm.jet)
             figure.colorbar(pcoa_plot,ax=subplot,label=legend_title)
             subplot.set_title(abundance_name)
             subplot.set(xlabel="PCoA 1 ("+str(pcoa1_x_label)+" %)",ylabel="PCoA 2 ("+str(pcoa2_y_label)+" %)")
-            subplot.tick_params(axis="both",bottom="off",labelbottom="off",left="off",labelleft="off")
+            subplot.tick_params(axis="both",bottom=False,labelbottom=False,left=False,labelleft=False)
              
         # adjust spacing between subplots
         figure.tight_layout()   
@@ -1379,7 +1951,7 @@ class PweaveDocument(Document):
 
     def show_pcoa(self, sample_names, feature_names, data, title, sample_types="samples", feature_types="species",
                   metadata=None, apply_transform=False, sort_function=None, metadata_type=None, outfilename=None):
-        """ Use the vegan package in R plus matplotlib to plot a PCoA.
+        """ Use matplotlib to plot a PCoA.
         Input data should be organized with samples as columns and features as rows.
         Data should be scaled to [0-1] if transform is to be applied.
 
@@ -1414,17 +1986,13 @@ class PweaveDocument(Document):
         :type sort_function: lambda
         """
 
-        import matplotlib.pyplot as pyplot
-        import matplotlib.colors as mcolors
-        import matplotlib.cm as cm
-        import matplotlib.patches as mpatches
-        import numpy as np
+        _import_plotting()
 
         pcoa_data, pcoa1_x_label, pcoa2_y_label = self.compute_pcoa(sample_names, feature_names, data, apply_transform)
 
         # create a figure subplot to move the legend
-        figure = pyplot.figure(figsize=(10,6),dpi=150)
-        subplot = pyplot.subplot(111)
+        figure = _get_figure(outfilename, figsize=(10,6), dpi=150)
+        subplot = figure.add_subplot(111)
         nancolor="grey"
 
         # create a set of custom colors to prevent overlap
@@ -1435,15 +2003,15 @@ class PweaveDocument(Document):
 
             if metadata_type == 'con':
 
-                cleaned_array = [value for value in metadata_categories if ~np.isnan(value)]
-                normalize = mcolors.Normalize(vmin=min(cleaned_array), vmax=max(cleaned_array))
+                cleaned_array = [value for value in metadata_categories if ~numpy.isnan(value)]
+                normalize = matplotlib.colors.Normalize(vmin=min(cleaned_array), vmax=max(cleaned_array))
                 colormap = pyplot.get_cmap('jet')
-                scalarmappaple = cm.ScalarMappable(norm=normalize, cmap=colormap)
+                scalarmappaple = matplotlib.cm.ScalarMappable(norm=normalize, cmap=colormap)
                 scalarmappaple.set_array(cleaned_array)
 
                 custom_colors_cont = []
                 for value in metadata_categories:
-                    if np.isnan(value):
+                    if numpy.isnan(value):
                         custom_colors_cont.append(nancolor)
                     else:
                         custom_colors_cont.append(colormap(normalize(value)))
@@ -1463,17 +2031,21 @@ class PweaveDocument(Document):
         subplot.set_position([subplot_position.x0, subplot_position.y0,
                               subplot_position.width * 0.70, subplot_position.height])
 
+        x_values, y_values = numpy.asarray(pcoa_data, dtype=float).reshape(-1, 2).T
         plots = []
         metadata_plots = {}
-        for i, (x, y) in enumerate(pcoa_data):
-            if metadata:
-                if metadata[sample_names[i]] not in metadata_plots:
-                    metadata_plots[metadata[sample_names[i]]] = [[x], [y]]
-                else:
-                    metadata_plots[metadata[sample_names[i]]][0].append(x)
-                    metadata_plots[metadata[sample_names[i]]][1].append(y)
-            else:
-                plots.append(subplot.scatter(x, y, color=next(custom_colors)))
+        if metadata:
+            # group the samples by metadata value so each group is drawn at once
+            for i in range(len(pcoa_data)):
+                metadata_plots.setdefault(metadata[sample_names[i]], []).append(i)
+        else:
+            # draw all of the samples at once
+            sample_colors = list(itertools.islice(custom_colors, len(pcoa_data)))
+            subplot.scatter(x_values, y_values, color=sample_colors)
+            if len(sample_names) <= self.max_labels_legend:
+                # add a marker for each sample to the legend
+                plots = [matplotlib.lines.Line2D([], [], linestyle="none", marker="o", color=color)
+                    for color in sample_colors]
 
         # order the plots alphabetically or numerically
         if not sort_function:
@@ -1482,17 +2054,18 @@ class PweaveDocument(Document):
             metadata_ordered_keys = sort_function(metadata_plots.keys())
 
         for key in metadata_ordered_keys:
-                plots.append(subplot.scatter(metadata_plots[key][0], metadata_plots[key][1],
+                indexes = metadata_plots[key]
+                plots.append(subplot.scatter(x_values[indexes], y_values[indexes],
                                          color=colors_by_metadata[key]))
 
 
-        pyplot.title(title)
-        pyplot.xlabel("PCoA 1 (" + str(pcoa1_x_label) + " %)")
-        pyplot.ylabel("PCoA 2 (" + str(pcoa2_y_label) + " %)")
+        subplot.set_title(title)
+        subplot.set_xlabel("PCoA 1 (" + str(pcoa1_x_label) + " %)")
+        subplot.set_ylabel("PCoA 2 (" + str(pcoa2_y_label) + " %)")
 
         # remove the tick marks on both axis
-        pyplot.tick_params(axis="x", which="both", bottom="off", labelbottom="off")
-        pyplot.tick_params(axis="y", which="both", left="off", labelleft="off")
+        subplot.tick_params(axis="x", which="both", bottom=False, labelbottom=False)
+        subplot.tick_params(axis="y", which="both", left=False, labelleft=False)
 
         if not metadata and len(sample_names) <= self.max_labels_legend:
             subplot.legend(plots, self.add_ellipse(sample_names), loc="center left", bbox_to_anchor=(1, 0.5),
@@ -1500,7 +2073,7 @@ class PweaveDocument(Document):
 
         if metadata:
             if metadata_type == 'con':
-                subplot.append = pyplot.colorbar(scalarmappaple)
+                subplot.append = figure.colorbar(scalarmappaple, ax=subplot)
                 if nancolor in custom_colors_cont:
                     figure.text(0.24, 0.01, "NA/Unknown values are shown in grey.")
 
@@ -1524,9 +2097,8 @@ class PweaveDocument(Document):
                  "represent the amount of variance explained by that axis."])
 
         if outfilename:
-            pyplot.savefig(outfilename)
+            figure.savefig(outfilename)
             print("\n\n![]("+outfilename+"){#id .class width=675px height=405px}\n\n")
-            pyplot.close()
         else:
             pyplot.draw()
 
@@ -9,6 +9,7 @@ import functools
 import shlex
 import copy
 import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import six
 
@@ -20,7 +21,7 @@ from .grid import Grid
 from .grid import GridWorker
 from .grid import GridQueue
 
-from .aws_batch_task import parse_s3, upload_file, download_file
+from .aws_batch_task import parse_s3, upload_object, download_object
 
 if os.name == 'posix' and sys.version_info[0] < 3:
     import subprocess32 as subprocess
@@ -98,20 +99,15 @@ class AWSGridWorker(GridWorker):
 
         task_name="task_"+str(task.task_no)
         task_pkl_file_basename = task_name+".pkl"
-        task_pkl_file=os.path.join(tmpdir,task_pkl_file_basename)
         task_result_pkl_file_basename = "result_"+task_name+".pkl"
-        task_result_pkl_file=os.path.join(tmpdir,task_result_pkl_file_basename)
 
-        # write the input pickle file
+        # write the input pickle file directly to the cloud
         resource = boto3.resource("s3")
         bucket, key, filename = parse_s3(task.targets[0])      
         input_s3 = "s3://"+bucket+"/"+task_pkl_file_basename
         output_s3 = "s3://"+bucket+"/"+task_result_pkl_file_basename
 
-        with open(task_pkl_file,"wb") as file_handle:
-            cloudpickle.dump(task,file_handle)
-        # copy to cloud
-        upload_file(resource,bucket,task_pkl_file_basename,task_pkl_file)
+        upload_object(resource,bucket,task_pkl_file_basename,cloudpickle.dumps(task))
 
         # update the task to run the pickle script
         pickle_task = copy.deepcopy(task)
@@ -122,14 +118,10 @@ class AWSGridWorker(GridWorker):
         # run the task as a command
         result = cls.run_task_command(pickle_task, extra)
 
-        # download the results
-        download_file(resource,bucket,task_result_pkl_file_basename,task_result_pkl_file)
-
-        # decode the result
+        # download and decode the results
         extra_error = None
         try:
-            with open(task_result_pkl_file,"rb") as file_handle:
-                result = cloudpickle.load(file_handle)
+            result = cloudpickle.loads(download_object(resource,bucket,task_result_pkl_file_basename))
         except (ValueError, EOFError, IOError):
             extra_error = "Unable to read task result, check the AWS batch logs"
 
@@ -159,6 +151,19 @@ class AWSQueue(GridQueue):
         # this is a lock for task definition submission
         self.lock_submit_task_definition = threading.Lock()
 
+        # these are the job definitions registered, by image, memory, and cpus
+        self.job_definitions = {}
+
+        # these are the ids of the jobs submitted that have not stopped
+        # and the last status of the jobs which have stopped (these will not change)
+        self.job_ids = []
+        self.stopped_job_status = []
+        self.lock_job_ids = threading.Lock()
+
+        # this is the pool to request the status for sets of jobs at the same time
+        # (reused for all refreshes, the batch client is thread safe once created)
+        self.status_pool = ThreadPoolExecutor(max_workers=8)
+
         self.partition = partition
 
         self.client = boto3.client("batch",region)
@@ -179,6 +184,17 @@ class AWSQueue(GridQueue):
     def get_job_id_from_submit_output(stdout):
         return stdout
 
+    def submit_job(self,grid_script):
+        """ Submit the grid job and record the job id to check its status """
+
+        jobid = super(AWSQueue, self).submit_job(grid_script)
+
+        if not self.job_submission_failed(jobid):
+            with self.lock_job_ids:
+                self.job_ids.append(jobid)
+
+        return jobid
+
     @staticmethod
     def submit_command(grid_script):   
         def submit_aws_batch(grid_script):
@@ -194,13 +210,31 @@ class AWSQueue(GridQueue):
             docker_image='amazonlinux'
 
         # get the partition for the task (to allow for multiple queues and partitions in task definition)
-        partition = self.get_partition(time, partition)
+        partition = self.get_partition(minutes, partition)
 
-        # create job definition
         job_name = "task_{}".format(taskid)
 
         # get lock to submit job definition
-        self.lock_submit_task_definition.acquire()
+        # (only one job definition is created for all of the tasks with the same requirements)
+        job_definition_key = (docker_image, memory, cpus)
+        with self.lock_submit_task_definition:
+            if not job_definition_key in self.job_definitions:
+                self.job_definitions[job_definition_key] = self.register_job_definition(docker_image, memory, cpus)
+
+        submit_script = functools.partial(self.client.submit_job,
+            containerOverrides={'command': shlex.split(command)},
+            jobDefinition=self.job_definitions[job_definition_key],
+            jobName=job_name,
+            jobQueue=partition)
+
+        return submit_script, None, None, None
+
+    def register_job_definition(self, docker_image, memory, cpus):
+        """ Register a job definition for the requirements returning the job definition arn """
+
+        # the name can only include letters, numbers, hyphens, and underscores
+        job_definition_name = re.sub(r"[^A-Za-z0-9_-]", "_",
+            "anadama2_{}_{}_{}".format(docker_image, memory, cpus))[:128]
 
         response = self.client.register_job_definition(
             containerProperties={
@@ -228,23 +262,14 @@ class AWSQueue(GridQueue):
                     }
                 ]
             },
-            jobDefinitionName=job_name,
+            jobDefinitionName=job_definition_name,
             type='container'
             )
 
         # pause after submission
         time.sleep(self.submit_definition_sleep)
 
-        # release lock
-        self.lock_submit_task_definition.release()
-
-        submit_script = functools.partial(self.client.submit_job,
-            containerOverrides={'command': shlex.split(command)},
-            jobDefinition=job_name,
-            jobName=job_name,
-            jobQueue=partition)
-
-        return submit_script, None, None, None
+        return response['jobDefinitionArn']
     
     def job_failed(self,status):
         # check if the job has a status that it failed
@@ -256,39 +281,28 @@ class AWSQueue(GridQueue):
 
     def refresh_queue_status(self):
         """ Get the latest status for all the grid jobs """
-   
-        def gather_job_status(response):
-            job_stats = []
-            for job in response['jobSummaryList']:
-                job_stats.append([job['jobId'],job['status'],"NA","NA","NA"])
-            return job_stats
-    
-        def list_jobs(state, nextToken=None):
-            if self.partition_long != self.partition_short:
-                if nextToken:
-                    response = self.client.list_jobs(jobQueue=self.partition_short,jobStatus=state,nextToken=nextToken)
-                    response2 = self.client.list_jobs(jobQueue=self.partition_long,jobStatus=state,nextToken=nextToken)
-                    if response2['jobSummaryList']:
-                        response['jobSummaryList']+=response2['jobSummaryList']
-                else:
-                    response = self.client.list_jobs(jobQueue=self.partition_short,jobStatus=state)
-                    response2 = self.client.list_jobs(jobQueue=self.partition_long,jobStatus=state)
-                    if response2['jobSummaryList']:
-                        response['jobSummaryList']+=response2['jobSummaryList']
-            else:
-                if nextToken:
-                    response = self.client.list_jobs(jobQueue=self.partition,jobStatus=state,nextToken=nextToken)
-                else:
-                    response = self.client.list_jobs(jobQueue=self.partition,jobStatus=state)
-            return response
 
+        # jobs can be described in sets of up to 100 ids
+        max_jobs_per_request = 100
+
+        with self.lock_job_ids:
+            job_ids = list(self.job_ids)
+
+        def describe_jobs(job_ids):
+            response = self.client.describe_jobs(jobs=job_ids)
+            return [[job['jobId'],job['status'],"NA","NA","NA"] for job in response['jobs']]
+
+        # request the status of each set of jobs at the same time
         job_status = []
-        for state in self.all_codes:
-            response = list_jobs(state)
-            job_status += gather_job_status(response)
-            while response.get('nextToken',None):
-                response = list_jobs(state, nextToken=response['nextToken'])
-                job_status += gather_job_status(response)
-        
-        return job_status
-    
+        job_id_sets = [job_ids[i:i+max_jobs_per_request] for i in range(0, len(job_ids), max_jobs_per_request)]
+        for job_set_status in self.status_pool.map(describe_jobs, job_id_sets):
+            job_status += job_set_status
+
+        # only check the status of the jobs that have not stopped in the next refresh
+        stopped_job_status = [job for job in job_status if self.job_stopped(job[1])]
+        stopped_job_ids = set(job[0] for job in stopped_job_status)
+        with self.lock_job_ids:
+            self.job_ids = [jobid for jobid in self.job_ids if not jobid in stopped_job_ids]
+            self.stopped_job_status += stopped_job_status
+
+        return [job for job in job_status if not job[0] in stopped_job_ids] + list(self.stopped_job_status)
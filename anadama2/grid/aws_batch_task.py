@@ -4,6 +4,7 @@
 
 import os
 import sys
+import io
 import argparse
 import shutil
 
@@ -43,6 +44,24 @@ def parse_s3(name):
 
     return bucket, key, filename
 
+# the transfer settings are created once for all uploads and downloads
+_transfer_config = None
+
+def get_transfer_config():
+    """ Get the transfer settings to copy larger files in concurrent parts """
+    global _transfer_config
+
+    if _transfer_config is None:
+        from boto3.s3.transfer import TransferConfig
+        _transfer_config = TransferConfig(
+            multipart_threshold=8*1024*1024,
+            multipart_chunksize=16*1024*1024,
+            max_concurrency=10,
+            io_chunksize=1024*1024,
+            use_threads=True)
+
+    return _transfer_config
+
 def download_file(resource,bucket,key,filename):
     """ Download a file from s3 """
     import botocore
@@ -50,14 +69,29 @@ def download_file(resource,bucket,key,filename):
     create_directories(filename)
 
     try:
-        resource.Bucket(bucket).download_file(key,filename)
+        resource.Bucket(bucket).download_file(key,filename,Config=get_transfer_config())
     except botocore.exceptions.ClientError:
         print("Unable to download file: s://"+bucket+"/"+key)
 
 def upload_file(resource,bucket,key,filename):
     """ Upload a file to s3 """
 
-    resource.Bucket(bucket).upload_file(filename,key)
+    resource.Bucket(bucket).upload_file(filename,key,Config=get_transfer_config())
+
+def download_object(resource,bucket,key):
+    """ Download the contents of a file from s3 without writing it to disk """
+    import botocore
+
+    try:
+        return resource.Object(bucket,key).get()['Body'].read()
+    except botocore.exceptions.ClientError:
+        print("Unable to download file: s://"+bucket+"/"+key)
+        return b""
+
+def upload_object(resource,bucket,key,contents):
+    """ Upload the contents of a file to s3 without writing it to disk """
+
+    resource.Bucket(bucket).upload_fileobj(io.BytesIO(contents),key,Config=get_transfer_config())
 
 def local_path(filename,working_directory):
     return filename.replace("s3://",working_directory)
@@ -81,30 +115,22 @@ def main():
     os.makedirs(args.working_directory)
     os.chdir(args.working_directory)
 
-    # download the input file from S3
+    # read in the task information from S3
     in_bucket, in_key, in_filename = parse_s3(args.input)
-    local_in_file = local_path(in_filename, args.working_directory)
-    download_file(resource,in_bucket,in_key,local_in_file)
-    
-    # read in the task information
-    task = cloudpickle.load(open(local_in_file,"rb"))
+    task = cloudpickle.loads(download_object(resource,in_bucket,in_key))
 
     # create folders for targets (if needed)
     for target in task.targets:
         target_local_path = try_get_local_path(target)
-        if isinstance(target_local_path, basestring):
+        if isinstance(target_local_path, six.string_types):
             create_directories(target_local_path)
 
     # run the task
     result = _run_task_locally(task)
 
-    # write the pickled results to a file
+    # upload the pickled results to S3
     out_bucket, out_key, out_filename = parse_s3(args.output)
-    local_out_file = local_path(out_filename, args.working_directory)
-    cloudpickle.dump(result,open(local_out_file,"wb"))
-
-    # upload the results to S3
-    upload_file(resource,out_bucket,out_key,local_out_file)
+    upload_object(resource,out_bucket,out_key,cloudpickle.dumps(result))
 
     # remove the working directory
     shutil.rmtree(args.working_directory)
@@ -492,13 +492,15 @@ class AWSHugeTrackedFile(HugeTrackedFile):
         directory = os.path.dirname(self.local)
         if not os.path.isdir(directory):
             os.makedirs(directory)
+        from .grid.aws_batch_task import get_transfer_config
         resource = boto3.resource("s3")
-        resource.Bucket(self.aws_bucket).download_file(self.aws_key,self.local)
+        resource.Bucket(self.aws_bucket).download_file(self.aws_key,self.local,Config=get_transfer_config())
 
     def upload(self):
         import boto3
+        from .grid.aws_batch_task import get_transfer_config
         resource = boto3.resource("s3")
-        resource.Bucket(self.aws_bucket).upload_file(self.local,self.aws_key)
+        resource.Bucket(self.aws_bucket).upload_file(self.local,self.aws_key,Config=get_transfer_config())
 
     def create_temp_folder(self):
         # create all temp folders needed for local path
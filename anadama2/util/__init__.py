@@ -475,9 +475,11 @@ def capture(stderr=None, stdout=None):
     if stdout:
         saved_stdout = sys.stdout
         sys.stdout = stdout
-    yield
-    if stderr:
-        sys.stderr = saved_stderr
-    if stdout:
-        sys.stdout = saved_stdout
+    try:
+        yield
+    finally:
+        if stderr:
+            sys.stderr = saved_stderr
+        if stdout:
+            sys.stdout = saved_stdout
     
@@ -1,10 +1,20 @@
 # -*- coding: utf-8 -*-
 import os
 import shutil
+import tempfile
 import unittest
 import optparse
 
+from six import StringIO
+
 import anadama2.document
+from anadama2.util import capture
+
+try:
+    import scipy
+    scipy_available=True
+except ImportError:
+    scipy_available=False
 
 
 class TestPweaveDocument(unittest.TestCase):
@@ -52,6 +62,83 @@ class TestPweaveDocument(unittest.TestCase):
         self.assertEqual(filtered_names,["s1","s2","s3"])
         for x,y in zip(filtered_data,[[0,0,1],[0,1,0],[1,0,0]]):
             self.assertListEqual(x,y)
+
+    def test_sorted_data_numerical_or_alphabetical(self):
+        doc = anadama2.document.PweaveDocument()
+
+        self.assertEqual(doc.sorted_data_numerical_or_alphabetical(["10","2","NA","1"]),["1","2","10","NA"])
+        self.assertEqual(doc.sorted_data_numerical_or_alphabetical(["b","NA","a"]),["NA","a","b"])
+
+    def test_write_table(self):
+        doc = anadama2.document.PweaveDocument()
+        tmpdir = tempfile.mkdtemp()
+        table_file = os.path.join(tmpdir,"table.tsv")
+
+        doc.write_table(["# ","s1","s2"],["f1","f2"],[[1,0.5],[0,2.25]],table_file)
+
+        with open(table_file) as file_handle:
+            self.assertEqual(file_handle.read(),"# \ts1\ts2\nf1\t1\t0.5\nf2\t0\t2.25\n")
+        shutil.rmtree(tmpdir)
+
+    def test_read_table(self):
+        doc = anadama2.document.PweaveDocument()
+        tmpdir = tempfile.mkdtemp()
+        table_file = os.path.join(tmpdir,"table.tsv")
+        with open(table_file,"w") as file_handle:
+            file_handle.write("# \ts1\ts2\nf1\t1\t0.5\nf2\tNA\t2.25\n")
+
+        columns, rows, data = doc.read_table(table_file)
+        self.assertEqual(columns,["s1","s2"])
+        self.assertEqual(rows,["f1","f2"])
+        self.assertEqual(data,[[1.0,0.5],[0.0,2.25]])
+
+        columns, rows, data = doc.read_table(table_file, format_data=int, only_data_columns=[1])
+        self.assertEqual(columns,["s2"])
+        self.assertEqual(data,[[0],[2]])
+
+        columns, rows, data = doc.read_table(table_file, only_data_columns=[1], as_array=True)
+        self.assertEqual(data.shape,(2,1))
+        self.assertEqual(data.tolist(),[[0.5],[2.25]])
+        shutil.rmtree(tmpdir)
+
+    def test_show_table_markdown(self):
+        doc = anadama2.document.PweaveDocument()
+        output = StringIO()
+        with capture(stdout=output):
+            doc.show_table_markdown([[1000,2],[3,"a|b"]],["r1","r2"],["c1","c2"],"Counts",format_data_comma=False)
+
+        lines = output.getvalue().strip().split("\n")
+        self.assertEqual(lines[0],"|   | c1 | c2 |")
+        self.assertEqual(lines[2],"| r1 | 1000 | 2 |")
+        self.assertEqual(lines[3],"| r2 | 3 | a\\|b |")
+        self.assertEqual(lines[-1],"Table: Counts")
+
+    def test_filter_zero_rows_and_columns(self):
+        doc = anadama2.document.PweaveDocument()
+        data=[[0,1,0],[0,0,0],[0,2,3]]
+
+        names, filtered = doc.filter_zero_rows(["f1","f2","f3"],data)
+        self.assertEqual(names,["f1","f3"])
+        self.assertEqual(filtered,[[0,1,0],[0,2,3]])
+
+        names, filtered = doc.filter_zero_columns(["s1","s2","s3"],data)
+        self.assertEqual(names,["s2","s3"])
+        self.assertEqual(filtered,[[1,0],[0,0],[2,3]])
+
+    @unittest.skipUnless(scipy_available, "requires scipy")
+    def test_compute_pcoa(self):
+        doc = anadama2.document.PweaveDocument()
+        samples=["s1","s2","s3","s4"]
+        features=["f1","f2","f3"]
+        data=[[0.5,0.1,0.0,0.2],[0.5,0.8,0.3,0.2],[0.0,0.1,0.7,0.6]]
+
+        pcoa_data, pcoa1_x_label, pcoa2_y_label = doc.compute_pcoa(samples,features,data,False)
+
+        self.assertEqual(len(pcoa_data),len(samples))
+        for row in pcoa_data:
+            self.assertEqual(len(row),2)
+        self.assertTrue(pcoa1_x_label >= pcoa2_y_label)
+        self.assertTrue(pcoa1_x_label + pcoa2_y_label <= 100)
         
     
         